@@ -1,15 +1,38 @@
 import multiprocessing
 import os
-from collections import defaultdict
 from functools import wraps
 
+import numpy as np
 import torch as th
 from torch import distributed as dist
+from torch.utils._pytree import tree_flatten, tree_map, tree_unflatten
 
 from utils.basics import pickle_load, logger
 
 cpu_group = None
 gpu_group = None
+# Low precision dtype for large float32 reductions. Set by ``initialize_distributed``
+compress_dtype = None
+compress_threshold = 1 << 20  # bytes
+# Scratch buffers of stack / cat, keyed by name and device. Larger buffers are allocated per call.
+_buffers = {}
+buffer_cache_limit = 64 << 20  # bytes
+# Cached once the default process group is initialized
+_rank = None
+_world_size = None
+
+# mean is reduced as a sum and divided afterwards, unless the backend supports AVG
+_REDUCE_OPS = {
+    "sum": dist.ReduceOp.SUM,
+    "mean": dist.ReduceOp.SUM,
+    "min": dist.ReduceOp.MIN,
+    "max": dist.ReduceOp.MAX,
+    "product": dist.ReduceOp.PRODUCT,
+}
+# dtypes whose values are all exactly representable in float32
+_FP32_EXACT_DTYPES = (th.float16, th.bfloat16, th.float32, th.bool, th.uint8, th.int8, th.int16)
+# dtypes whose values can share a flat buffer of int64, float32 or float64
+_FUSIBLE_DTYPES = _FP32_EXACT_DTYPES + (th.int32, th.int64, th.float64)
 
 
 def initialize_deepspeed(cfg):
@@ -22,22 +45,29 @@ def initialize_deepspeed(cfg):
 
 
 def initialize_distributed(cfg, logger):
-    cfg.is_distributed = False
-    cfg.world_size = int(os.getenv('WORLD_SIZE', '1'))
+    global compress_dtype
+    if cfg.get('reduce_dtype') is not None:
+        if cfg.reduce_dtype not in ('bfloat16', 'float16'):
+            raise ValueError("reduce_dtype must be `bfloat16` or `float16`, got `%s`" % cfg.reduce_dtype)
+        compress_dtype = getattr(th, cfg.reduce_dtype)
+        logger.info(f"Reducing float32 buffers of at least {compress_threshold} bytes in {cfg.reduce_dtype}")
+    env = os.environ
+    cfg.world_size = int(env.get('WORLD_SIZE', '1'))
+    cfg.is_distributed = cfg.world_size > 1
     logger.info(f"world_size={cfg.world_size}")
     if th.cuda.is_available():
-        cfg.master_ip = os.getenv('MASTER_ADDR', 'localhost')
-        cfg.master_port = os.getenv('MASTER_PORT', '6000')
-        cfg.local_rank = int(os.getenv('RANK', '0')) % th.cuda.device_count()
-        device = cfg.local_rank % th.cuda.device_count()
-        th.cuda.set_device(device)
-        cfg.is_distributed = th.cuda.device_count() > 1
+        num_devices = th.cuda.device_count()
+        cfg.master_ip = env.get('MASTER_ADDR', 'localhost')
+        cfg.master_port = env.get('MASTER_PORT', '6000')
+        # LOCAL_RANK indexes the devices of this node, while RANK counts across nodes
+        cfg.local_rank = int(env.get('LOCAL_RANK', env.get('RANK', '0'))) % num_devices
+        th.cuda.set_device(cfg.local_rank)
     else:
         cfg.local_rank = 0
 
-    if cfg.world_size > 1 and not dist.is_initialized():
+    if cfg.is_distributed and dist.is_available() and not dist.is_initialized():
         logger.info(f"init_process_group")
-        init_process_group("nccl", init_method="env://")  
+        init_process_group("nccl" if th.cuda.is_available() else "gloo", init_method="env://")
 
 
 def process_on_master_and_sync_by_pickle(cache_arg=None, cache_kwarg=None, log_func=logger.info):
@@ -51,13 +81,13 @@ def process_on_master_and_sync_by_pickle(cache_arg=None, cache_kwarg=None, log_f
             else:
                 log_func('No cache file specified')
             skip_cache = kwargs.pop('skip_cache', False)
-            if not os.path.exists(filename) or skip_cache:
-                if get_rank() == 0:  # Master process
-                    func(*args, **kwargs)
-            else:
+            if os.path.exists(filename) and not skip_cache:
+                # Cache hit: every rank reads the file directly, no barrier needed
                 if get_rank() == 0:  # Master process
                     log_func(f'Loaded cache {filename}, skipped {func.__name__}')
                 return pickle_load(filename)
+            if get_rank() == 0:  # Master process
+                func(*args, **kwargs)
             synchronize()
             assert os.path.exists(filename), f'The {filename} must be saved in the {func.__name__}'
             return pickle_load(filename)
@@ -84,8 +114,12 @@ def get_rank():
 
     Return 0 for single process case.
     """
+    global _rank
+    if _rank is not None:
+        return _rank
     if dist.is_initialized():
-        return dist.get_rank()
+        _rank = dist.get_rank()
+        return _rank
     if "RANK" in os.environ:
         return int(os.environ["RANK"])
     return 0
@@ -97,8 +131,12 @@ def get_world_size():
 
     Return 1 for single process case.
     """
+    global _world_size
+    if _world_size is not None:
+        return _world_size
     if dist.is_initialized():
-        return dist.get_world_size()
+        _world_size = dist.get_world_size()
+        return _world_size
     if "WORLD_SIZE" in os.environ:
         return int(os.environ["WORLD_SIZE"])
     return 1
@@ -128,8 +166,12 @@ def init_process_group(backend, init_method=None, **kwargs):
     """
     global cpu_group
     global gpu_group
+    global _rank
+    global _world_size
 
     dist.init_process_group(backend, init_method, **kwargs)
+    _rank = dist.get_rank()
+    _world_size = dist.get_world_size()
     gpu_group = dist.group.WORLD
     if backend == "nccl":
         cpu_group = dist.new_group(backend="gloo")
@@ -149,60 +191,200 @@ def synchronize():
     Synchronize among all distributed processes.
     """
     if get_world_size() > 1:
-        dist.barrier()
-
-
-def _recursive_read(obj):
-    values = defaultdict(list)
-    sizes = defaultdict(list)
-    if isinstance(obj, th.Tensor):
-        values[obj.dtype] += [obj.flatten()]
-        sizes[obj.dtype] += [th.tensor([obj.numel()], device=obj.device)]
-    elif isinstance(obj, dict):
-        for v in obj.values():
-            child_values, child_sizes = _recursive_read(v)
-            for k, v in child_values.items():
-                values[k] += v
-            for k, v in child_sizes.items():
-                sizes[k] += v
-    elif isinstance(obj, list) or isinstance(obj, tuple):
-        for v in obj:
-            child_values, child_sizes = _recursive_read(v)
-            for k, v in child_values.items():
-                values[k] += v
-            for k, v in child_sizes.items():
-                sizes[k] += v
-    else:
+        if dist.get_backend() == "nccl":
+            # Pin the barrier to this process's device instead of the one NCCL guesses from the rank
+            dist.barrier(device_ids=[th.cuda.current_device()])
+        else:
+            dist.barrier()
+
+
+def _all_gather(s, local, group, async_op=False):
+    """
+    Gather ``local`` of every worker into the rows of ``s``.
+    Only NCCL supports gathering into a single tensor. Other backends gather into the list of rows.
+    """
+    if dist.get_backend(group) == "nccl":
+        return dist.all_gather_into_tensor(s, local, group=group, async_op=async_op)
+    return dist.all_gather(list(s), local, group=group, async_op=async_op)
+
+
+def _check_tensor(obj):
+    if not isinstance(obj, th.Tensor):
         raise ValueError("Unknown type `%s`" % type(obj))
-    return values, sizes
+    return obj
 
 
-def _recursive_write(obj, values, sizes=None):
-    if isinstance(obj, th.Tensor):
-        if sizes is None:
-            size = th.tensor([obj.numel()], device=obj.device)
-        else:
-            s = sizes[obj.dtype]
-            size, s = s.split([1, len(s) - 1])
-            sizes[obj.dtype] = s
-        v = values[obj.dtype]
-        new_obj, v = v.split([size, v.shape[-1] - size], dim=-1)
+def _flatten(obj):
+    """
+    Flatten any nested container of tensors, and bucket the flattened tensors by dtype.
+
+    Return the tensors, the container structure, and the values and sizes of each dtype.
+    """
+    leaves, spec = tree_flatten(obj)
+    values = {}
+    sizes = {}
+    for leaf in map(_check_tensor, leaves):
+        values.setdefault(leaf.dtype, []).append(leaf.flatten())
+        sizes.setdefault(leaf.dtype, []).append(leaf.numel())
+    return leaves, spec, values, sizes
+
+
+def _unflatten(leaves, spec, values, sizes):
+    """
+    Split the buffer of each dtype back into tensors shaped like ``leaves``, and rebuild the container.
+
+    Parameters:
+        leaves (list of Tensor): tensors returned by ``_flatten``
+        spec (TreeSpec): container structure returned by ``_flatten``
+        values (dict): buffer of each dtype. Tensors are concatenated along the last axis.
+        sizes (dict): size of each tensor along the last axis of the buffer
+    """
+    chunks = {k: iter(v.split(sizes[k], dim=-1)) for k, v in values.items()}
+    new_leaves = []
+    for leaf in leaves:
+        new_leaf = next(chunks[leaf.dtype])
         # compatible with reduce / stack / cat
-        new_obj = new_obj.view(new_obj.shape[:-1] + (-1,) + obj.shape[1:])
-        values[obj.dtype] = v
-        return new_obj, values
-    elif isinstance(obj, dict):
-        new_obj = {}
-        for k, v in obj.items():
-            new_obj[k], values = _recursive_write(v, values, sizes)
-    elif isinstance(obj, list) or isinstance(obj, tuple):
-        new_obj = []
-        for v in obj:
-            new_v, values = _recursive_write(v, values, sizes)
-            new_obj.append(new_v)
+        new_leaves.append(new_leaf.view(new_leaf.shape[:-1] + (-1,) + leaf.shape[1:]))
+    return tree_unflatten(new_leaves, spec)
+
+
+def _byte_layout(numels):
+    """
+    Lay out dtype buckets in a flat byte buffer. Wider dtypes are placed first, so that every bucket starts
+    at an offset aligned to its element size and can be viewed in place.
+
+    Parameters:
+        numels (dict): number of elements of each dtype
+
+    Return the (start, end) byte span of each dtype and the buffer size, padded to 8 bytes.
+    """
+    spans = {}
+    offset = 0
+    for dtype in sorted(numels, key=lambda k: (-k.itemsize, str(k))):
+        spans[dtype] = (offset, offset + numels[dtype] * dtype.itemsize)
+        offset = spans[dtype][1]
+    return spans, -(-offset // 8) * 8
+
+
+def _reduce_buckets(dtypes):
+    """
+    Group dtypes into flat buffers whose dtype holds all their values exactly.
+
+    Return the dtypes of each buffer, keyed by the dtype of the buffer.
+    """
+    buckets, fused = {}, []
+    has_float = any(k.is_floating_point for k in dtypes)
+    for k in dtypes:
+        # float64 can't hold every int64, and other dtypes can't be cast exactly at all.
+        # Reduce them in buffers of their own
+        if k not in _FUSIBLE_DTYPES or (k == th.int64 and has_float):
+            buckets[k] = [k]
+        else:
+            fused.append(k)
+    if fused:
+        buckets[_reduce_dtype(fused)] = fused
+    return buckets
+
+
+def _reduce_dtype(dtypes):
+    """
+    Get the dtype of a flat buffer that holds the values of all the given dtypes exactly.
+    """
+    # NCCL can't solve bool. Hold them as byte
+    if all(k in (th.bool, th.uint8) for k in dtypes):
+        return th.uint8
+    # Nothing to fuse, so keep the native dtype
+    if len(set(dtypes)) == 1:
+        return dtypes[0]
+    if not any(k.is_floating_point for k in dtypes):
+        return th.int64
+    if all(k in _FP32_EXACT_DTYPES for k in dtypes):
+        return th.float32
+    return th.float64
+
+
+def _get_buffer(name, size, device):
+    """
+    Get a uint8 scratch buffer of ``size`` bytes that is reused across calls. Its content is undefined.
+
+    Parameters:
+        name (str): purpose of the buffer. Buffers that are alive at the same time need different names.
+        size (int): number of bytes
+        device (th.device): device of the buffer
+    """
+    if size > buffer_cache_limit:
+        return th.empty(size, dtype=th.uint8, device=device)
+    buf = _buffers.get((name, device))
+    if buf is None or len(buf) < size:
+        buf = _buffers[(name, device)] = th.empty(size, dtype=th.uint8, device=device)
+    return buf[:size]
+
+
+def clear_buffers():
+    """
+    Release the scratch buffers cached by ``stack`` and ``cat``.
+    """
+    _buffers.clear()
+
+
+def _pack(values, spans, size):
+    """
+    Concatenate the flattened tensors of each dtype into their byte spans of a uint8 scratch buffer.
+    """
+    device = next(iter(values.values()))[0].device
+    buf = _get_buffer("send", size, device)
+    for k, v in values.items():
+        start, end = spans[k]
+        th.cat(v, out=buf[start:end].view(k))
+    return buf
+
+
+def _reduce_bucket(values, sizes, keys, dtype, op, is_mean, dst):
+    """
+    Reduce the values of the given dtypes in a single flat buffer.
+
+    Parameters:
+        values (dict): flattened tensors of each dtype
+        sizes (dict): number of elements of each flattened tensor
+        keys (list of th.dtype): dtypes to reduce
+        dtype (th.dtype): dtype of the flat buffer
+        op (ReduceOp): reduction operator. ``mean`` is passed as ``SUM``.
+        is_mean (bool): divide the result by the number of workers
+        dst (int): rank of destination worker. If None, broadcast the result to all workers.
+
+    Return the reduced buffer of each dtype.
+    """
+    numels = [sum(sizes[k]) for k in keys]
+    v = th.empty(sum(numels), dtype=dtype, device=values[keys[0]][0].device)
+    # Bool buckets in a byte buffer are reinterpreted rather than cast
+    as_bytes = v.dtype == th.uint8
+    for k, chunk in zip(keys, v.split(numels)):
+        th.cat(values[k], out=chunk.view(k) if as_bytes else chunk)
+    group = get_group(v.device)
+    is_nccl = dist.get_backend(group) == "nccl"
+    is_float = all(k.is_floating_point for k in keys)
+    # NCCL can fold the division of mean into the reduction. Only gloo and integer buckets need a separate pass.
+    is_avg = is_mean and is_float and is_nccl
+    if is_avg:
+        op = dist.ReduceOp.AVG
+    # Large float32 sums can be sent in a lower precision to halve the traffic. min / max / product are kept exact.
+    # Buckets holding other dtypes are never compressed, since fp16 values may not survive a cast to bfloat16.
+    if compress_dtype is not None and is_nccl and all(k == th.float32 for k in keys) \
+            and op in (dist.ReduceOp.SUM, dist.ReduceOp.AVG) and v.numel() * v.element_size() >= compress_threshold:
+        buf = v.to(compress_dtype)
     else:
-        raise ValueError("Unknown type `%s`" % type(obj))
-    return new_obj, values
+        buf = v
+    if dst is None:
+        dist.all_reduce(buf, op=op, group=group)
+    else:
+        dist.reduce(buf, op=op, dst=dst, group=group)
+    if buf is not v:
+        v.copy_(buf)
+    if is_mean and not is_avg:
+        v = v.div_(get_world_size()) if v.is_floating_point() else v / get_world_size()
+    # Sums of bool may exceed 1, so only min / max / product results can be viewed back as bool
+    as_bytes = as_bytes and op != dist.ReduceOp.SUM
+    return {k: chunk.view(k) if as_bytes else chunk.type(k) for k, chunk in zip(keys, v.split(numels))}
 
 
 def reduce(obj, op="sum", dst=None):
@@ -224,30 +406,22 @@ def reduce(obj, op="sum", dst=None):
         >>> obj = comm.reduce(obj)
         >>> assert th.allclose(obj["polynomial"], x ** 3 + x ** 2 + x + 1)
     """
-    values = _recursive_read(obj)[0]
-    values = {k: th.cat(v) for k, v in values.items()}
+    if get_world_size() == 1:
+        return tree_map(lambda x: _check_tensor(x).view(-1, *x.shape[1:]), obj)
+
+    leaves, spec, values, sizes = _flatten(obj)
+    if not leaves:
+        return obj
 
     is_mean = op == "mean"
-    if is_mean:
-        op = "sum"
-    op = getattr(dist.ReduceOp, op.upper())
+    op = _REDUCE_OPS[op]
 
+    # Buckets are cast into as few flat buffers as can hold them exactly, usually one
     reduced = {}
-    for k, v in values.items():
-        dtype = v.dtype
-        # NCCL can't solve bool. Cast them to byte
-        if dtype == th.bool:
-            v = v.byte()
-        group = get_group(v.device)
-        if dst is None:
-            dist.all_reduce(v, op=op, group=group)
-        else:
-            dist.reduce(v, op=op, dst=dst, group=group)
-        if is_mean:
-            v = v / get_world_size()
-        reduced[k] = v.type(dtype)
+    for dtype, keys in _reduce_buckets(list(values)).items():
+        reduced.update(_reduce_bucket(values, sizes, keys, dtype, op, is_mean, dst))
 
-    return _recursive_write(obj, reduced)[0]
+    return _unflatten(leaves, spec, reduced, sizes)
 
 
 def stack(obj, dst=None):
@@ -268,25 +442,25 @@ def stack(obj, dst=None):
         >>> truth = th.stack([th.ones_like(x), x, x ** 2, x ** 3]
         >>> assert th.allclose(obj["exponent"], truth))
     """
-    values = _recursive_read(obj)[0]
-    values = {k: th.cat(v) for k, v in values.items()}
-
-    stacked = {}
-    for k, v in values.items():
-        dtype = v.dtype
-        # NCCL can't solve bool. Cast them to byte
-        if dtype == th.bool:
-            dtype = th.uint8
-        s = th.zeros(get_world_size(), *v.shape, dtype=dtype, device=v.device)
-        s[get_rank()] = v
-        group = get_group(s.device)
-        if dst is None:
-            dist.all_reduce(s, op=dist.ReduceOp.SUM, group=group)
-        else:
-            dist.reduce(s, op=dist.ReduceOp.SUM, dst=dst, group=group)
-        stacked[k] = s.type(v.dtype)
+    if get_world_size() == 1:
+        return tree_map(lambda x: _check_tensor(x).view(1, -1, *x.shape[1:]), obj)
+
+    leaves, spec, values, sizes = _flatten(obj)
+    if not leaves:
+        return obj
+    # All dtypes are packed into one byte buffer, so a single all-gather moves every bucket
+    spans, size = _byte_layout({k: sum(v) for k, v in sizes.items()})
+    local = _pack(values, spans, size)
+
+    s = th.empty(get_world_size(), size, dtype=th.uint8, device=local.device)
+    group = get_group(s.device)
+    if dst is None:
+        _all_gather(s, local, group)
+    else:
+        dist.gather(local, list(s) if get_rank() == dst else None, dst=dst, group=group)
+    stacked = {k: s[:, start:end].view(k) for k, (start, end) in spans.items()}
 
-    return _recursive_write(obj, stacked)[0]
+    return _unflatten(leaves, spec, stacked, sizes)
 
 
 def cat(obj, dst=None):
@@ -306,32 +480,46 @@ def cat(obj, dst=None):
         >>> obj = comm.cat(obj)
         >>> assert th.allclose(obj["range"], rng)
     """
-    values, sizes = _recursive_read(obj)
-    sizes = {k: th.cat(v) for k, v in sizes.items()}
+    if get_world_size() == 1:
+        return tree_map(lambda x: _check_tensor(x).view(-1, *x.shape[1:]), obj)
+
+    leaves, spec, values, sizes = _flatten(obj)
+    if not leaves:
+        return obj
+    rank = get_rank()
+    world_size = get_world_size()
+    # Sizes are only metadata. Exchange them as python objects over the CPU group, without touching the GPU.
+    worker_sizes = [None] * world_size
+    dist.all_gather_object(worker_sizes, sizes, group=get_group(th.device("cpu")))
+    size = {k: np.array([s[k] for s in worker_sizes], dtype=np.int64) for k in sizes}  # size[k]: (num_worker, num_obj)
+    worker_numels = {k: v.sum(axis=1).tolist() for k, v in size.items()}
+    # All dtypes are packed into one byte buffer, so a single all-gather moves every bucket.
+    # Each worker's layout depends on its own sizes, and uneven contributions are padded to the largest one.
+    layouts = [_byte_layout({k: v[i] for k, v in worker_numels.items()}) for i in range(world_size)]
+    chunk_size = max(n for _, n in layouts)
+    local = _pack(values, layouts[rank][0], chunk_size)
+
+    # Objects are copied out of the gathered buffer by th.cat, so it can be reused as well
+    s = _get_buffer("gather", world_size * chunk_size, local.device).view(world_size, chunk_size)
+    group = get_group(s.device)
+    if dst is None:
+        work = _all_gather(s, local, group, async_op=True)
+    else:
+        work = dist.gather(local, list(s) if rank == dst else None, dst=dst, group=group, async_op=True)
+
+    # Slice out every object while the gather is in flight. Views only touch metadata, not the data.
+    chunks = {}
+    for k, v in size.items():
+        chunks[k] = []
+        for i, (spans, _) in enumerate(layouts):
+            start, end = spans[k]
+            chunks[k].append(s[i, start:end].split((v[i] * k.itemsize).tolist()))
+    work.wait()
 
-    sizes = stack(sizes)
     cated = {}
-    for k, value in values.items():
-        size = sizes[k].t().flatten()  # sizes[k]: (num_worker, num_obj)
-        dtype = value[0].dtype
-        # NCCL can't solve bool. Cast them to byte
-        if dtype == th.bool:
-            dtype = th.uint8
-        s = th.zeros(size.sum(), dtype=dtype, device=value[0].device)
-        obj_id = get_rank()
-        world_size = get_world_size()
-        offset = size[:obj_id].sum()
-        for v in value:
-            assert offset + v.numel() <= len(s)
-            s[offset: offset + v.numel()] = v
-            offset += size[obj_id: obj_id + world_size].sum()
-            obj_id += world_size
-        group = get_group(s.device)
-        if dst is None:
-            dist.all_reduce(s, op=dist.ReduceOp.SUM, group=group)
-        else:
-            dist.reduce(s, op=dist.ReduceOp.SUM, dst=dst, group=group)
-        cated[k] = s.type(value[0].dtype)
-    sizes = {k: v.sum(dim=0) for k, v in sizes.items()}
+    for k, v in chunks.items():
+        # Interleave the workers' chunks so that each object is contiguous
+        cated[k] = th.cat([v[i][j] for j in range(len(v[0])) for i in range(world_size)]).view(k)
+    sizes = {k: v.sum(axis=0).tolist() for k, v in size.items()}
 
-    return _recursive_write(obj, cated, sizes)[0]
+    return _unflatten(leaves, spec, cated, sizes)